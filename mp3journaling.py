@@ -3,40 +3,61 @@
 from pathlib import Path
 import os
 from collections import namedtuple, defaultdict
-from itertools import zip_longest
-from enum import Enum
-import re
-from typing import List
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from itertools import chain, zip_longest
+from operator import attrgetter
+from enum import IntEnum
 from tqdm import tqdm
+import shutil
 import subprocess
-import eyed3
+from mutagen.mp3 import MP3
 from datetime import datetime
 
 # Recording contain the mp3 path and the track marker file path
-SegmentedRecord = namedtuple('SegmentedRecord', ['record_name', 'mp3_files', 'tmk_files'])
+# (and, for segmented ones, the length and creation time of each mp3 file once they have been sorted
+# and which of the track marker files are placeholders)
+SegmentedRecord = namedtuple('SegmentedRecord', ['record_name', 'mp3_files', 'tmk_files', 'durations', 'creation_times', 'tmk_is_placeholder'],
+                             defaults=[None, None, None])
 Record = namedtuple('Record', ['record_name', 'mp3_file', 'tmk_file'])
 
 
-# Track mark patterns
-Pattern = Enum('Pattern', ["IMPORTANT_THOUGHT",
-                           "IMPORTANT_THOUGHT_LONG",
-                           "IMPORTANT_CONVERSATION",
-                           "CONFIDENTIAL",
-                           "PROJECT_IDEA",
-                           ])
+# Track mark patterns (their value is the number of track marks in the group)
+# IntEnum members hash like ints, which is a lot cheaper than Enum's __hash__ for the dict lookups below
+Pattern = IntEnum('Pattern', ["IMPORTANT_THOUGHT",
+                              "IMPORTANT_THOUGHT_LONG",
+                              "IMPORTANT_CONVERSATION",
+                              "CONFIDENTIAL",
+                              "PROJECT_IDEA",
+                              ])
+
+# Patterns indexed by their value (i.e. the number of track marks in the group),
+# cheaper than calling Pattern(value) for every window
+PatternByValue = (None,) + tuple(Pattern)
 
 # How many track mark to jump over when encoutering one of the patterns
-PatternSkips = {"IMPORTANT_THOUGHT": 1,
-                "IMPORTANT_THOUGHT_LONG": 2,
-                "IMPORTANT_CONVERSATION": 4,
-                "CONFIDENTIAL": 5,
-                "PROJECT_IDEA": 5,
+# (keyed by the Pattern members directly so lookups don't go through .name)
+PatternSkips = {Pattern.IMPORTANT_THOUGHT: 1,
+                Pattern.IMPORTANT_THOUGHT_LONG: 2,
+                Pattern.IMPORTANT_CONVERSATION: 4,
+                Pattern.CONFIDENTIAL: 5,
+                Pattern.PROJECT_IDEA: 5,
                 }
 
-PatternTime = {"IMPORTANT_THOUGHT": 60,
-               "IMPORTANT_THOUGHT_LONG": 120,
-               "PROJECT_IDEA": 300,
-                }
+PatternTime = {Pattern.IMPORTANT_THOUGHT: 60,
+               Pattern.IMPORTANT_THOUGHT_LONG: 120,
+               Pattern.PROJECT_IDEA: 300,
+               }
+
+# For the patterns closed by a later track mark, position (counted from the first track mark
+# of the group) of the track marks delimiting the segment: the last one of the group and the closing one
+PatternBounds = {Pattern.IMPORTANT_CONVERSATION: (2, 3),
+                 Pattern.CONFIDENTIAL: (3, 4),
+                 }
+
+# Number of track marks in the longest pattern (no group can be bigger than that)
+LongestPattern = max(Pattern)
 
 IMPORTANT_THOUGHT = 1
 IMPORTANT_THOUGHT_LONG = 2
@@ -47,312 +68,356 @@ CONFIDENTIAL = 4
 IMPORTANT_THOUGHT_TIME = 120
 IMPORTANT_THOUGHT_LONG_TIME = 600
 
-# Time interval object
-TimeInterval = namedtuple('TimeInterval', ['start', 'end', 'type'])
+# Buffer size (in bytes) used when writing merged files
+IO_BUFFER_SIZE = 1 << 20
+
+# Maximum number of segments cut by a single ffmpeg command (each one is a separate input and output,
+# so two file descriptors and a demuxer, too many and ffmpeg runs out of file descriptors, 256 by default on macOS)
+MAX_SEGMENTS_PER_FFMPEG = 64
+
+# Time interval object (one is created per pattern found)
+@dataclass(frozen=True)
+class TimeInterval:
+    start: float
+    end: float
+    type: Pattern
 
 def read_track_markers(filename: Path) -> list:
     """This functions open the TMK file linked to the MP3 and returns
-       all the track marker in it in a list of timestamps"""
+       all the track marker in it in a list of timestamps
+       (empty lines, like the one the TX660 puts at the end, are skipped)"""
     with open(filename, 'r', encoding="utf-8-sig") as track_marker_file:
-        lines = track_marker_file.readlines()
-        track_markers = []
-        for line in lines:
-            track_markers.append(line.strip())
-        return track_markers
-
-def track_mark_interval_to_seconds(first, second):
-    """This function converts the interval between two track markers to seconds"""
-    second_converted = track_mark_to_seconds(second)
-    if first is None:
-        return second_converted
-
-    first_converted = track_mark_to_seconds(first)
-    return second_converted - first_converted
+        # Track markers never contain whitespace, so a single split() both strips
+        # the lines and drops the empty ones
+        return track_marker_file.read().split()
 
 def track_mark_to_seconds(track_mark):
     """This function converts a track mark to seconds"""
     return float(track_mark[1:6]) * 60 + float(track_mark[7:12])
 
-def seconds_to_track_marker(seconds):
-    """This function converts seconds to a track marker"""
-    minutes = int(seconds // 60)
-    seconds = seconds % 60
-    m_str = f"{minutes:05}"
-    s_str = f"{seconds:05.2f}"
-    return f"[{m_str}:{s_str}]"
-
-def get_windows(track_marks, interval=30):
-    """This function returns a list of the number of track marks
-       within the window of width INTERVAL"""
-    windows = []
-    total_time = 0
-    track_mark_counter = 0
-    index = 0
-    reset = True
-    while index < len(track_marks):
-        if track_mark_counter <= 4:
-            if reset:
-                reset = False
-            else:
-                total_time += track_mark_interval_to_seconds(track_marks[index-1], track_marks[index])
-            index += 1
-
-        # If we have reached the longest possible pattern
-        if track_mark_counter >= max(pattern.value for pattern in Pattern):
-            windows.append(Pattern(track_mark_counter))
-            # Depending on the amount of track markers detected in a row,
-            # the next track marker may get skipped since it belongs to this group
-            # if track_mark_counter in [Pattern.CONFIDENTIAL, Pattern.IMPORTANT_CONVERSATION]:
-            #     index += 1
-            track_mark_counter = 0
-            total_time = 0
-            reset = True
-        # Exceeded the maximum time interval, so we reached the next pattern or this is a CONVERSATION/CONFIDENTIAL
-        elif total_time > interval:
-            # Move the index back once if this is part of a new group of track markers
-            if track_mark_counter not in [Pattern.CONFIDENTIAL.value, Pattern.IMPORTANT_CONVERSATION.value]:
-                index -= 1
-            windows.append(Pattern(track_mark_counter))
-            # Depending on the amount of track markers detected in a row,
-            # the next track marker may get skipped since it belongs to this group
-            # if track_mark_counter in [Pattern.CONFIDENTIAL, Pattern.IMPORTANT_CONVERSATION]:
-            #     index += 1
-            track_mark_counter = 0
-            total_time = 0
-            reset = True
-        else:
-            track_mark_counter += 1
-
-    # Last track marker group may exit the loop without being treated if they
-    # reach the end of the list of track marker
-    if track_mark_counter > 0:
-        windows.append(Pattern(track_mark_counter))
+def track_marks_to_seconds(track_marks):
+    """This function converts a whole list of track marks to seconds in one pass
+       so that callers never have to parse the same track mark twice"""
+    return list(map(track_mark_to_seconds, track_marks))
 
-    return windows
+def read_track_markers_seconds(filename: Path) -> list:
+    """This function reads the TMK file and returns its track markers already
+       converted to seconds, so they are parsed only once when the file is loaded"""
+    return track_marks_to_seconds(read_track_markers(filename))
 
-def find_track_mark_patterns(track_marks, maxTimeInterval=30):
+def seconds_to_track_marker(seconds):
+    """This function converts seconds to a track marker"""
+    minutes, seconds = divmod(seconds, 60)
+    return "[%05d:%05.2f]" % (minutes, seconds)
+
+def get_window_sizes(track_marks_seconds, interval=30):
+    """This function yields the number of track marks
+       within each window of width INTERVAL. The track marks must
+       already be converted to seconds (see track_marks_to_seconds).
+       Only works with plain numbers, mapping them to patterns is left to get_windows"""
+    track_marks_count = len(track_marks_seconds)
+    group_start = 0
+    while group_start < track_marks_count:
+        # Add the following track marks to the group as long as they stay within
+        # the interval (measured from the first track mark of the group)
+        group_size = 1
+        total_time = 0
+        while group_size < LongestPattern and group_start + group_size < track_marks_count:
+            total_time += track_marks_seconds[group_start + group_size] - track_marks_seconds[group_start + group_size - 1]
+            if total_time > interval:
+                break
+            group_size += 1
+        yield group_size
+        # The track mark closing a CONVERSATION/CONFIDENTIAL belongs to it, the next group starts after it
+        # (Pattern members hash like their value, so the size can be looked up in PatternBounds directly)
+        group_start += group_size
+        if group_size in PatternBounds:
+            group_start += 1
+
+def get_windows(track_marks_seconds, interval=30):
+    """This function returns the list of patterns formed by the track marks
+       (see get_window_sizes)"""
+    return [PatternByValue[window_size] for window_size in get_window_sizes(track_marks_seconds, interval)]
+
+def find_track_mark_patterns(track_marks_seconds, maxTimeInterval=30):
     """This function finds the track markers pattern in the TMK file.
        List of possible patterns:
        1. T: marks the last X minutes as important
        2. TT: marks the last Y minutes as important
        3. TTT-T marks whatever is in between the three first and last track mark as important
        4. TTTT-T marks whatever is in between the four first and last track mark as confidential
-          (aka. must be deleted if it is included in any other recording via overlapping)"""
-    windows = get_windows(track_marks, maxTimeInterval)
+          (aka. must be deleted if it is included in any other recording via overlapping)
+       The track marks must already be converted to seconds (see read_track_markers_seconds)"""
+    windows = get_windows(track_marks_seconds, maxTimeInterval)
     # Rename the window and create the appropriate time interval for each segment
     time_intervals = []
     index = 0
     for window in windows:
-        # Avoid saving a part that overlaps with the previous segments
-        minimum = track_mark_to_seconds(track_marks[index-1]) if index > 0 else 0
-
-        if window == Pattern.IMPORTANT_THOUGHT or window == Pattern.IMPORTANT_THOUGHT_LONG or window == Pattern.PROJECT_IDEA:
-            start = max(minimum, track_mark_to_seconds(track_marks[index]) - PatternTime[window.name])
-            end = track_mark_to_seconds(track_marks[index])
-            time_intervals.append(TimeInterval(start, end, Pattern(window)))
-        elif window == Pattern.IMPORTANT_CONVERSATION:
-            # Start at the last track mark of the group of 3
-            start = track_mark_to_seconds(track_marks[index + 2])
-            end = track_mark_to_seconds(track_marks[index + 3])
-            time_intervals.append(TimeInterval(start, end, Pattern(window)))
-        elif window == Pattern.CONFIDENTIAL:
-            # Start at the last track mark of the group of 4
-            start = track_mark_to_seconds(track_marks[index + 3])
-            end = track_mark_to_seconds(track_marks[index + 4])
-            time_intervals.append(TimeInterval(start, end, Pattern(window)))
+        if window in PatternTime:
+            # Save the last X seconds before the track mark
+            end = track_marks_seconds[index]
+            # Avoid saving a part that overlaps with the previous segments
+            minimum = track_marks_seconds[index-1] if index > 0 else 0
+            start = max(minimum, end - PatternTime[window])
         else:
-            raise ValueError("Invalid number of track markers detected")
+            # Save what is in between the last track mark of the group and the closing one
+            start_offset, end_offset = PatternBounds[window]
+            start = track_marks_seconds[index + start_offset]
+            end = track_marks_seconds[index + end_offset]
+        time_intervals.append(TimeInterval(start, end, window))
         # Skip N markers based on the pattern we just analyzed
-        index += PatternSkips[window.name]
+        index += PatternSkips[window]
     return time_intervals
 
-def concatenate_audio_files(audio_file_paths: List[Path], output_path: Path, verbose=1):
-    """This functions concatenates multiple audio files in a single using pydub"""
-    if verbose > 0:
-        print("Concatenating audio files...")
-        audio_file_paths = tqdm(audio_file_paths)
-    # Create the output file
-    output_file = open(output_path, "wb")
-    for audio_file_path in audio_file_paths:
-        # Concatenate mp3 file using cat subprocess
-        subprocess.run(["cat", str(audio_file_path)], stdout=output_file, check=True)
-    if verbose > 0:
-        print("Audio files concatenated.")
-    output_file.close()
+def get_mp3_duration(mp3_file_path: Path) -> float:
+    """Returns the length of an mp3 file in seconds. Only the mp3 headers are read"""
+    return MP3(mp3_file_path).info.length
 
-def concatenate_track_marker_files(record, output_path: Path, verbose=1):
-    """This functions concatenates multiple track marker files in a single file"""
+def concatenate_record_files(record, mp3_output_path: Path, tmk_output_path: Path, verbose=1):
+    """This functions concatenates the audio files of a segmented record in a single file
+       and its track marker files in another one. Both are done in the same pass over the
+       segments so each of them is only visited once."""
     if verbose > 0:
-        print("Concatenating track marker files...")
-        mp3_track_pair_path = tqdm(zip(record.mp3_files, record.tmk_files))
-    # Create the output file
+        print("Concatenating audio and track marker files...")
+    # There may be less track marker files than mp3 files (none after the last track marker)
+    segments = zip_longest(record.mp3_files, record.durations, record.tmk_files, record.tmk_is_placeholder)
+    if verbose > 0:
+        segments = tqdm(segments, total=len(record.mp3_files))
+    # Create the output files
     total_time = 0
-    first_file = True
-    with open(output_path, "w", encoding="utf-8-sig") as output_file:
-        for mp3_file_path, track_markers_path in mp3_track_pair_path:
+    with open(mp3_output_path, "wb") as mp3_output_file, \
+         open(tmk_output_path, "w", encoding="utf-8-sig", buffering=IO_BUFFER_SIZE) as tmk_output_file:
+        for mp3_file_path, track_length, track_markers_path, is_placeholder in segments:
+            # Concatenate mp3 file by appending its bytes (no need to spawn a process per file)
+            with open(mp3_file_path, "rb") as mp3_file:
+                shutil.copyfileobj(mp3_file, mp3_output_file, IO_BUFFER_SIZE)
             # If placeholder file, skip but add mp3 time to total time (for mp3 with no track marker associated with them)
-            if track_markers_path.name != "placeholder.tmk":
-                # Add the track marker from each file in the new track marker file
-                with open(track_markers_path, 'r', encoding="utf-8-sig") as track_markers_file:
-                    if first_file:
-                        first_file = False
-                        output_file.write(track_markers_file.read())
-                    else:
-                        # Add total time to every track marker of this file
-                        track_markers_file.seek(0)
-                        for track_marker_line in track_markers_file:
-                            # Check if last line of file (TX660 puts empty line at the end)
-                            if track_marker_line.strip() == '':
-                                break
-
-                            # Create new track marker with added total time
-                            orig_track_mark_seconds = track_mark_to_seconds(track_marker_line.strip())
-                            new_track_mark_seconds = orig_track_mark_seconds + total_time
-                            new_track_mark_line = seconds_to_track_marker(new_track_mark_seconds)
-                            output_file.write(new_track_mark_line + "\n")
-            if first_file:
-                first_file = False
-            # Get the track lenght of the mp3 file and add it to the total time
-            track_length = eyed3.load(mp3_file_path).info.time_secs
+            if track_markers_path is not None and not is_placeholder:
+                # Add the track marker from each file in the new track marker file with added total time
+                if total_time == 0:
+                    # Nothing to shift (first file), copy the track markers as they are instead of parsing and formatting them back
+                    tmk_output_file.write("".join([track_mark + "\n" for track_mark in read_track_markers(track_markers_path)]))
+                else:
+                    track_marks_seconds = read_track_markers_seconds(track_markers_path)
+                    tmk_output_file.write("".join([seconds_to_track_marker(track_mark_seconds + total_time) + "\n"
+                                                   for track_mark_seconds in track_marks_seconds]))
+            # Add the track lenght of the mp3 file to the total time
             total_time += track_length
 
     if verbose > 0:
-        print("Track marker files concatenated.")
+        print("Audio and track marker files concatenated.")
 
 def insert_placeholder_files(record):
     """This function inserts placeholder files in the record so that, when it comes time to concatenate them, the program knows that some mp3 have no
        track marker associated with them and then know how to merge the tmk file while keeping a correct track of time."""
     new_tmk_path_list = []
+    tmk_is_placeholder = []
     placeholder_path = record.mp3_files[0].parent.joinpath("placeholder.tmk")
-    index = 0
-    for tmk_file_path in record.tmk_files:
-        tmk_start_time = tmk_file_path.stat().st_birthtime
-        for mp3_file_path in record.mp3_files[index:]:
-            track_length = eyed3.load(mp3_file_path).info.time_secs
-            mp3_start_time = mp3_file_path.stat().st_birthtime
-            index += 1
-            if mp3_start_time + track_length < tmk_start_time:
-                new_tmk_path_list.append(placeholder_path)
-                continue
-            else:
-                new_tmk_path_list.append(tmk_file_path)
-                break
+    tmk_start_times = [tmk_file_path.stat().st_birthtime for tmk_file_path in record.tmk_files]
+    # Both lists are sorted, so walk them side by side: every mp3 that ends before the next tmk file
+    # was created gets a placeholder, the first one that doesn't gets the tmk file
+    tmk_index = 0
+    for mp3_start_time, track_length in zip(record.creation_times, record.durations):
+        if tmk_index == len(record.tmk_files):
+            break
+        if mp3_start_time + track_length < tmk_start_times[tmk_index]:
+            new_tmk_path_list.append(placeholder_path)
+            tmk_is_placeholder.append(True)
+        else:
+            new_tmk_path_list.append(record.tmk_files[tmk_index])
+            tmk_is_placeholder.append(False)
+            tmk_index += 1
 
-    new_record = SegmentedRecord(record_name=record.record_name, mp3_files=record.mp3_files, tmk_files=new_tmk_path_list)
+    new_record = record._replace(tmk_files=new_tmk_path_list, tmk_is_placeholder=tmk_is_placeholder)
     return new_record
 
 
-def search_and_combine_recordings(path: Path):
+def get_record_name(filename):
+    """Returns the record name shared by every segment of a recording, that is, the
+       part of the filename before the first underscore. Files that do not follow
+       the <record name>_<segment>_ naming scheme return None."""
+    record_name, separator, rest = filename.partition("_")
+    segment, segment_separator, _ = rest.lstrip("_").partition("_")
+    if record_name and separator and segment and segment_separator:
+        return record_name
+    return None
+
+def merge_record(record, path: Path):
+    """Merges the .mp3 and .tmk files of a segmented record into a single pair of files
+       saved in PATH and returns the resulting Record."""
+    # Sort the files, even if there is only one recording
+    # (have to do it here to avoid having the name section in both branch)
+    record.mp3_files.sort(key=attrgetter("name"))
+    record.tmk_files.sort(key=attrgetter("name"))
+    # Read the length and creation time of every mp3 file once, both the placeholders and the concatenation need them
+    record = record._replace(durations=[get_mp3_duration(mp3_file_path) for mp3_file_path in record.mp3_files],
+                             creation_times=[mp3_file_path.stat().st_birthtime for mp3_file_path in record.mp3_files])
+    # Insert placeholder tmk files if some mp3 have no track marker associated with them
+    record = insert_placeholder_files(record)
+    # Get first mp3 creation date and time
+    creation_time_datetime = datetime.fromtimestamp(record.creation_times[0])
+    datetime_formatted = creation_time_datetime.strftime("%Y-%m-%d@%Hh%Mm%Ss")
+    # New record name
+    new_mp3_path = path.joinpath(datetime_formatted + "_merged" + ".mp3")
+    new_tmk_path = path.joinpath(datetime_formatted + "_merged" + ".tmk")
+    # Check if it is segmented or not
+    if len(record.mp3_files) > 1:
+        concatenate_record_files(record, new_mp3_path, new_tmk_path)
+        # Delete old files (placeholders were never written to disk, missing_ok covers them)
+        for old_file in chain(record.mp3_files, record.tmk_files):
+            old_file.unlink(missing_ok=True)
+    else:
+        # Rename the files to the record name
+        os.replace(record.mp3_files[0], new_mp3_path)
+        if len(record.tmk_files) > 0:
+            os.replace(record.tmk_files[0], new_tmk_path)
+        else:
+            new_tmk_path = path.joinpath("EMPTY.tmk")
+    return Record(record_name=record.record_name,
+                  mp3_file=new_mp3_path,
+                  tmk_file=new_tmk_path)
+
+def search_and_combine_recordings(path: Path, max_workers=None):
     """Returns a list containing all the recording in a folder.
-       Renames the recordings to be unique and concatenates them in a single file."""
+       Renames the recordings to be unique and concatenates them in a single file.
+       Recordings are merged in parallel using up to MAX_WORKERS processes
+       (defaults to the number of CPUs, 1 merges them sequentially)."""
     file_pairs = defaultdict(lambda: defaultdict(list))
     # Group .mp3 and .tmk that have the same filename prefix together
-    for entry in path.iterdir():
-        if entry.is_file():
-            match = re.search(r"([^_]+)_+[^_]+_", entry.name)
-            if match:
-                _, file_extension = os.path.splitext(entry.name)
-                file_pairs[match.group(1)][file_extension].append(entry)
+    # (scandir entries know their file type without an extra stat call per file)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                record_name = get_record_name(entry.name)
+                if record_name:
+                    file_path = Path(entry.path)
+                    file_pairs[record_name][file_path.suffix].append(file_path)
     # Combine the recordings
     temp_records = []
     for key, value in file_pairs.items():
         temp_records.append(SegmentedRecord(record_name=key, mp3_files=value[".mp3"], tmk_files=value[".tmk"]))
 
-    # For each recording, merge the .mp3 and .tmk files
-    final_records = []
-    for record in temp_records:
-        # Sort the files, even if there is only one recording
-        # (have to do it here to avoid having the name section in both branch)
-        record.mp3_files.sort(key=lambda x: x.name)
-        record.tmk_files.sort(key=lambda x: x.name)
-        # Insert placeholder tmk files if some mp3 have no track marker associated with them
-        record = insert_placeholder_files(record)
-        # Get first mp3 creation date and time using pathlib
-        first_mp3_creation_time = record.mp3_files[0].stat().st_birthtime
-        creation_time_datetime = datetime.fromtimestamp(first_mp3_creation_time)
-        datetime_formatted = creation_time_datetime.strftime("%Y-%m-%d@%Hh%Mm%Ss")
-        # New record name
-        new_mp3_path = path.joinpath(datetime_formatted + "_merged" + ".mp3")
-        new_tmk_path = path.joinpath(datetime_formatted + "_merged" + ".tmk")
-        # Check if it is segmented or not
-        if len(record.mp3_files) > 1:
-            concatenate_audio_files(record.mp3_files, new_mp3_path)
-            concatenate_track_marker_files(record, new_tmk_path)
-            # Delete old files
-            for mp3_file, tmk_file in zip_longest(record.mp3_files, record.tmk_files):
-                try:
-                    mp3_file.unlink(missing_ok=True)
-                    tmk_file.unlink(missing_ok=True)
-                except AttributeError:
-                    pass
-        else:
-            # Rename the files to the record name
-            record.mp3_files[0].rename(new_mp3_path)
-            if len(record.tmk_files) > 0:
-                record.tmk_files[0].rename(new_tmk_path)
-            else:
-                new_tmk_path = path.joinpath("EMPTY.tmk")
-        # Add the new recording to the list
-        final_records.append(Record(record_name=record.record_name,
-                                    mp3_file=new_mp3_path,
-                                    tmk_file=new_tmk_path))
-
-    return final_records
-
-def split_audio_based_on_track_marks_pattern(record):
-    """Splits the mp3 file into segments based on track marker pattern"""
+    # Each recording is merged independently of the others, so spread them over multiple processes
+    if max_workers == 1 or len(temp_records) < 2:
+        return [merge_record(record, path) for record in temp_records]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(partial(merge_record, path=path), temp_records))
+
+def split_audio_based_on_track_marks_pattern(record, max_workers=None):
+    """Splits the mp3 file into segments based on track marker pattern
+       (see split_audio_file_into_segments for MAX_WORKERS)"""
     # Get the track marks pattern (check if they are any first)
     if record.tmk_file.name == "EMPTY.tmk":
         return
-    track_marks = read_track_markers(record.tmk_file)
-    track_marks_patterns = find_track_mark_patterns(track_marks)
+    track_marks_seconds = read_track_markers_seconds(record.tmk_file)
+    track_marks_patterns = find_track_mark_patterns(track_marks_seconds)
     # Split the mp3 file into segments
-    split_audio_file_into_segments(record, track_marks_patterns)
+    split_audio_file_into_segments(record, track_marks_patterns, max_workers)
 
-def split_audio_file_into_segments(record, track_marks_patterns):
-    """Splits the mp3 file into segments based on track marker pattern"""
+def split_audio_file_into_segments(record, track_marks_patterns, max_workers=None):
+    """Splits the mp3 file into segments based on track marker pattern.
+       The segments are spread over up to MAX_WORKERS ffmpeg commands running in parallel
+       (defaults to the number of CPUs, 1 runs a single ffmpeg command at a time)."""
     # Split the mp3 file into segments
+    segments = []
     index_of_types = {pattern: 0 for pattern in list(Pattern)}
     #index_of_types = {Pattern.IMPORTANT_THOUGHT: 0, Pattern.IMPORTANT_THOUGHT_LONG: 0, Pattern.IMPORTANT_CONVERSATION: 0}
+    # The same for every segment of the recording, so only computed once
+    mp3_timestamp = datetime.strptime(record.mp3_file.name.split("_")[0], "%Y-%m-%d@%Hh%Mm%Ss").timestamp()
+    mp3_file_path = record.mp3_file.resolve()
+    # Segments go next to the merged mp3 itself, not next to the file it links to
+    output_directory = record.mp3_file.parent.resolve()
+    # Output directories already created for this recording, by (segment type, recording date)
+    segment_directories = {}
     for track_marks_pattern in track_marks_patterns:
         segment_type = track_marks_pattern.type
         if segment_type == Pattern.CONFIDENTIAL:
             continue
         index_of_types[segment_type] += 1
-        timestamps = [track_mark_to_ffmpeg_timestamps(track_mark_seconds) for track_mark_seconds in track_marks_pattern[0:2]]
+        timestamps = [track_mark_to_ffmpeg_timestamps(track_mark_seconds) for track_mark_seconds in (track_marks_pattern.start, track_marks_pattern.end)]
         # Create datetime formated name for the segment based on when that segment happened
-        mp3_timestamp = datetime.strptime(record.mp3_file.name.split("_")[0], "%Y-%m-%d@%Hh%Mm%Ss").timestamp()
-        segment_timestamp = mp3_timestamp + track_marks_pattern[0]
+        segment_timestamp = mp3_timestamp + track_marks_pattern.start
         segment_datetime = datetime.fromtimestamp(segment_timestamp)
         # String representing the date of the recording of the segment
         recording_date_formatted = segment_datetime.strftime("%Y-%m-%d")
         # String representing the date and time at which the segment starts
         segment_datetime_formatted = segment_datetime.strftime("%Y-%m-%d@%Hh%Mm%Ss")
         segment_filename = segment_datetime_formatted + "_" + segment_type.name + "_" + str(index_of_types[segment_type]) + ".mp3"
-        output_file_name = record.mp3_file.parent.joinpath(segment_type.name).joinpath(recording_date_formatted).joinpath(segment_filename)
-
-        # Create output directory if it doesn't exist
-        output_file_name.parent.mkdir(parents=True, exist_ok=True)
-        # Create the new MP3 segment file
-        subprocess.run(["ffmpeg", "-i", record.mp3_file.resolve(), "-ss",
-                         timestamps[0], "-to", timestamps[1], "-acodec", "copy", output_file_name.resolve()],
-                         stdout=subprocess.DEVNULL, check=True)
+        # Create output directory if it doesn't exist (only once per directory, most segments share it)
+        segment_directory = segment_directories.get((segment_type, recording_date_formatted))
+        if segment_directory is None:
+            segment_directory = output_directory.joinpath(segment_type.name, recording_date_formatted)
+            segment_directory.mkdir(parents=True, exist_ok=True)
+            segment_directories[segment_type, recording_date_formatted] = segment_directory
+        output_file_name = segment_directory.joinpath(segment_filename)
+        # Add the new MP3 segment file to the ones to create
+        segments.append((timestamps[0], timestamps[1], output_file_name))
+
+    # Create all the new MP3 segment files
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    batch_count = min(max_workers, len(segments))
+    if batch_count == 1:
+        cut_segments(mp3_file_path, segments)
+    elif batch_count > 1:
+        # Deal the segments in turn to each batch so they all get some from across the whole recording
+        batches = [segments[batch_index::batch_count] for batch_index in range(batch_count)]
+        # Threads are enough here since the work is done by the ffmpeg processes
+        with ThreadPoolExecutor(max_workers=batch_count) as executor:
+            list(executor.map(partial(cut_segments, mp3_file_path), batches))
+
+def cut_segments(mp3_file_path: Path, segments):
+    """Creates the SEGMENTS, a list of (start, end, output path) tuples, of the mp3 file using
+       one ffmpeg command per MAX_SEGMENTS_PER_FFMPEG segments (run one after the other).
+       The mp3 file is given once as input per segment with the seek options before it (input seeking),
+       so ffmpeg jumps straight to each segment instead of reading the whole file from the start."""
+    for batch_start in range(0, len(segments), MAX_SEGMENTS_PER_FFMPEG):
+        batch = segments[batch_start:batch_start + MAX_SEGMENTS_PER_FFMPEG]
+        # Only let ffmpeg report errors, its banner and progress output would be interleaved between the parallel commands.
+        # They must not touch the terminal either: each one would save and restore its settings and they would all wait on the
+        # same keyboard, so ffmpeg gets no stdin (-nostdin and DEVNULL) and overwrites existing segments without asking (-y)
+        ffmpeg_command = ["ffmpeg", "-nostdin", "-y", "-hide_banner", "-loglevel", "error"]
+        for start, end, _ in batch:
+            ffmpeg_command.extend(["-ss", start, "-to", end, "-i", mp3_file_path])
+        for input_index, (_, _, output_file_name) in enumerate(batch):
+            ffmpeg_command.extend(["-map", f"{input_index}:a", "-acodec", "copy", output_file_name])
+        subprocess.run(ffmpeg_command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
 
 def track_mark_to_ffmpeg_timestamps(track_mark_seconds):
-    """Converts a track marker to ffmpeg timestamps"""
-    hours = int(track_mark_seconds // 3600)
-    minutes = int((track_mark_seconds % 3600) // 60)
-    seconds = int(track_mark_seconds % 60)
-    return f"{hours}:{minutes}:{seconds}"
+    """Converts a track marker to ffmpeg timestamps
+       (ffmpeg takes plain seconds, keeping the fraction so the cut isn't truncated to the second)"""
+    return f"{track_mark_seconds:.3f}"
+
+def process_recording(record, max_workers=None):
+    """Splits a merged recording into segments and deletes the merged files afterward
+       (see split_audio_file_into_segments for MAX_WORKERS)"""
+    split_audio_based_on_track_marks_pattern(record, max_workers)
+    # Only reached if every ffmpeg command succeeded: a failing one raises (check=True) and the exception must be let through
+    # so the merged files are kept, some segments may be missing or only partly written and have to be cut again from them
+    # Delete the merged mp3 file
+    record.mp3_file.unlink(missing_ok=True)
+    record.tmk_file.unlink(missing_ok=True)
+
+def process_recordings(records, max_workers=None):
+    """Splits all the merged recordings into segments.
+       Recordings are processed in parallel using up to MAX_WORKERS threads
+       (defaults to the number of CPUs, 1 processes them sequentially),
+       which keeps the number of ffmpeg running at the same time to one per CPU."""
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_workers == 1 or len(records) < 2:
+        for record in records:
+            process_recording(record, max_workers)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # The recordings already run in parallel, so each one runs a single ffmpeg command at a time
+        # Consume the results so that exceptions raised in the threads are not lost
+        list(executor.map(partial(process_recording, max_workers=1), records))
 
 if __name__ == '__main__':
     # Get all recordings in the folder
     recordings = search_and_combine_recordings(Path(r'/Users/zach-mcc/MP3 Journal'))
-    for recording in recordings:
-        # Split all of them into segments
-        split_audio_based_on_track_marks_pattern(recording)
-        # Delete the merged mp3 file
-        recording.mp3_file.unlink(missing_ok=True)
-        recording.tmk_file.unlink(missing_ok=True)
+    # Split all of them into segments
+    process_recordings(recordings)
 
     print("Operation completed!")